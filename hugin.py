@@ -62,6 +62,8 @@ def main():
     try:
         config.read(args.i)
         munin_vt.VT_PUBLIC_API_KEY = config['DEFAULT']['VT_PUBLIC_API_KEY']
+        if config.has_option('VIRUSTOTAL', 'RATE_LIMIT'):
+            munin_vt.setRateLimit(float(config.get('VIRUSTOTAL', 'RATE_LIMIT')))
         try:
             connections.setProxy(config['DEFAULT']['PROXY'])
         except KeyError as e:
@@ -0,0 +1,185 @@
+import time
+import traceback
+from typing import Any, Dict, Iterable, List
+
+# Publishers (first signer) that mark a signed sample as Microsoft software
+MICROSOFT_PUBLISHERS = ('Microsoft Corporation', 'Microsoft Windows')
+
+def uniqList(listx: Iterable[Any]) -> List[Any]:
+    # returns the unique elements of a list
+    return list(set(listx))
+
+SIZE_NAMES = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+
+def convertSize(size_bytes: int) -> str:
+    """
+    Converts number of bytes to a readable form
+    Source: https://stackoverflow.com/questions/5194057/better-way-to-convert-file-sizes-in-python
+    :param size_bytes:
+    :return:
+    """
+    if size_bytes <= 0:
+       return "0B"
+    # every unit step is 10 bits (1024)
+    i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_NAMES) - 1)
+    s = round(size_bytes / (1 << (i * 10)), 2)
+    return "%s %s" % (s, SIZE_NAMES[i])
+
+def formatTimestamp(timestamp: int) -> str:
+    """
+    Formats a UNIX timestamp as UTC date string (YYYY-MM-DD HH:MM:SS)
+    :param timestamp:
+    :return:
+    """
+    tm = time.gmtime(timestamp)
+    return f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d} {tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
+
+def getEmptyInfo() -> Dict[str, Any]:
+    return {
+        'hash': '-',
+        "result": "- / -",
+        "virus": "-",
+        "last_submitted": "-",
+        "first_submitted": "-",
+        "filenames": "-",
+        "filetype": "-",
+        "rating": "unknown",
+        "positives": 0,
+        "imphash": "-",
+        "harmless": False,
+        "revoked": False,
+        "signed": False,
+        "expired": False,
+        "mssoft": False,
+        "vendor_results": {},
+        "signer": "-",
+        "vt_queried": True,
+        "tags": [],
+        "copyright": "-", 
+        "description": "-",
+        "times_submitted": 0, 
+        "reputation": 0, 
+        "filesize": 0}
+
+def get_crossplatfrom_basename(path: str) -> str:
+    return path.replace("\\", "/").rpartition("/")[2]
+
+def processVirustotalSampleInfo(sample_info: Dict[str, Any], debug: bool = False, VENDORS: List[str] = ['ALL']) -> Dict[str, Any]:
+    """
+    Processes a v3 API information dictionary of a sample and extracts useful data
+    """
+    info = getEmptyInfo()
+
+    attrs = sample_info.get('attributes')
+    if not attrs:
+        return info
+
+    # Get file names
+    # (insertion ordered dict removes duplicates and keeps the meaningful name first, if available)
+    filenames: Dict[str, None] = {}
+    if 'meaningful_name' in attrs:
+        filenames[get_crossplatfrom_basename(attrs['meaningful_name'])] = None
+    for name in attrs.get('names', []):
+        filenames.setdefault(get_crossplatfrom_basename(name), None)
+    if filenames:
+        info["filenames"] = ", ".join(filenames).replace(';', '_')
+    # Get file type
+    info['filetype'] = attrs.get('type_description', info['filetype'])
+    # Get file size
+    if 'size' in attrs:
+        info['filesize'] = convertSize(attrs['size'])
+    # Get tags
+    info['tags'] = attrs.get('tags', info['tags'])
+    # First submission
+    if 'first_submission_date' in attrs:
+        info['first_submitted'] = formatTimestamp(attrs['first_submission_date'])
+    # Times submitted
+    info['times_submitted'] = attrs.get('times_submitted', info['times_submitted'])
+    # Reputation
+    info['reputation'] = attrs.get('reputation', info['reputation'])
+
+    # Exiftool
+    exif = attrs.get('exiftool', {})
+    # Get copyright
+    info['copyright'] = exif.get('LegalCopyright', info['copyright'])
+    # Get description
+    info['description'] = exif.get('FileDescription', info['description'])
+    # PE Info
+    info['imphash'] = attrs.get('pe_info', {}).get('imphash', info['imphash'])
+    # PE Signature
+    sig = attrs.get('signature_info', {})
+    # Signer
+    info['signer'] = sig.get('signers', info['signer'])
+    # Valid
+    verified = sig.get('verified', '')
+    info['signed'] = verified == "Signed"
+    info['revoked'] = "Revoked" in verified
+    info['expired'] = "Expired" in verified
+
+    # Hashes
+    for hash_type in ('md5', 'sha1', 'sha256'):
+        if hash_type in attrs:
+            info[hash_type] = attrs[hash_type]
+    # AV matches
+    try:
+        stats = attrs["last_analysis_stats"]
+        info["positives"] = stats["malicious"] + stats["suspicious"]
+        info["total"] = stats["undetected"] + info["positives"] + stats["harmless"]
+        if info["positives"] == 0:
+            info["rating"] = "clean"
+        elif info["positives"] <= 10:
+            info["rating"] = "suspicious"
+        else:
+            info["rating"] = "malicious"
+    except KeyError:
+        print("[W] Missing analysis stats for sample %s" % sample_info.get('id', '-'))
+        if debug:
+            traceback.print_exc()
+
+    # Harmless / Microsoft software (v2 API legacy flags, now derived from the v3 attributes)
+    trusted_verdict = attrs.get('trusted_verdict', {})
+    # (whitelist verdict only, like the v2 "Probably harmless!" - a single engine voting harmless isn't enough)
+    info['harmless'] = trusted_verdict.get('verdict') == 'goodware'
+    # (only the publisher, the first signer of the chain, counts - WHQL signed third-party drivers carry
+    # "Microsoft Windows Hardware Compatibility Publisher" further down the chain)
+    info['mssoft'] = 'Microsoft' in trusted_verdict.get('organization', '') or \
+                     (info['signed'] and info['signer'].split(';')[0].strip() in MICROSOFT_PUBLISHERS)
+
+    # Last submission
+    if 'last_submission_date' in attrs:
+        info["last_submitted"] = formatTimestamp(attrs['last_submission_date'])
+    # Virus Name
+    scans = attrs.get('last_analysis_results', {})
+
+    # limit output of VT vendor scan results to those named in VENDORS, unless it's 'ALL'
+    loop_vendors = scans if VENDORS[0] == 'ALL' else VENDORS
+    info["vendor_results"] = {
+        vendor: (scans[vendor]["result"] or "-") if vendor in scans else "-" for vendor in loop_vendors
+    }
+    virus_names = [f"{vendor}: {result}" for vendor, result in info["vendor_results"].items() if result != "-"]
+
+    if len(virus_names) > 0:
+        info["virus"] = " / ".join(virus_names)
+
+    # Return the info dictionary
+    return info
+
+def getEmptyCommentInfo() -> Dict[str, Any]:
+    return {
+        "comments": 0,
+        "commenter": ['-'],
+        "tags": []
+    }
+
+def processVirustotalComments(r_comments: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Processes a v3 API comments response of a sample and extracts commenters and tags
+    """
+    info = getEmptyCommentInfo()
+    info['comments'] = len(r_comments['data'])
+    if len(r_comments['data']) > 0:
+        info['commenter'] = []
+        for com in r_comments['data']:
+            info['commenter'].append(com['relationships']['author']['data']['id'])
+            info['tags'].extend(com['attributes']['tags'])
+    return info
@@ -1,11 +1,18 @@
-from datetime import datetime
-import json
-import math
+import asyncio
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
 import requests
-import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import random
+import sys
 import traceback
 import time
 from lib.connections import PROXY
+# Pure data processing helpers, can be compiled with mypyc (see README)
+from lib._munin_vt_hot import uniqList, convertSize, formatTimestamp, getEmptyInfo, get_crossplatfrom_basename, \
+    processVirustotalSampleInfo, getEmptyCommentInfo, processVirustotalComments
 
 RETROHUNT_URL = 'https://www.virustotal.com/api/v3/intelligence/retrohunt_jobs'
 VT_COMMENT_API = 'https://www.virustotal.com/api/v3/files/%s/comments?relationships=author'
@@ -14,7 +21,145 @@ VT_REPORT_URL = 'https://www.virustotal.com/api/v3/files/%s'
 
 VT_PUBLIC_API_KEY = "-"
 
-def getVTInfo(hash, debug=False, vtallvendors=False, QUOTA_EXCEEDED_WAIT_TIME=600, vtwaitquota=False):
+# Shared session for the synchronous API requests (keep-alive and connection pooling)
+# The adapter only retries server errors - quota errors (429) are handled by getVTInfo (--vtwaitquota) and
+# network errors by its backoff loop, so that no retries get stacked on top of each other
+VT_SESSION = requests.Session()
+VT_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, connect=0, read=0, other=0, backoff_factor=0.5,
+                      status_forcelist=[500, 502, 503, 504], respect_retry_after_header=False,
+                      raise_on_status=False)
+))
+
+# Pacing of the asynchronous API requests (rate limit off by default, enable it with setRateLimit / RATE_LIMIT in munin.ini)
+VT_RATE_LIMIT = None
+VT_RATE_PERIOD = 60
+# maximum number of asynchronous API requests in flight at the same time
+VT_MAX_CONCURRENCY = 16
+VT_MAX_RETRIES = 5
+# longest Retry-After wait that is honored before giving up on a request
+VT_MAX_RETRY_AFTER = 600
+VT_RETRY_STATUS = (429, 500, 502, 503, 504)
+# Timeouts of the asynchronous API requests (retrohunt pages with 300 files can take a while)
+VT_ASYNC_TIMEOUT = httpx.Timeout(120.0, connect=30.0)
+
+# Number of retrohunt files per progress dot
+PROGRESS_STEP = 50
+
+def setRateLimit(max_rate, time_period=VT_RATE_PERIOD):
+    """
+    Sets the rate limit for the asynchronous API requests
+    :param max_rate: number of requests allowed per time period
+    :param time_period: length of the time period in seconds
+    :return:
+    """
+    global VT_RATE_LIMIT, VT_RATE_PERIOD
+    VT_RATE_LIMIT = max_rate
+    VT_RATE_PERIOD = time_period
+
+def getVTAsyncLimiter():
+    """
+    Creates the rate limiter for one run of asynchronous API requests (None if no rate limit is set)
+    :return:
+    """
+    if not VT_RATE_LIMIT:
+        return None
+    return AsyncLimiter(VT_RATE_LIMIT, VT_RATE_PERIOD)
+
+def tuneRateLimit(limiter, headers, debug=False):
+    """
+    Adapts the rate limiter to the X-Ratelimit-* headers of a response (if sent)
+    :param limiter: rate limiter of the current run
+    :param headers: response headers
+    :return:
+    """
+    # only re-tune a configured limiter
+    if limiter is None:
+        return
+    try:
+        limit = float(headers['X-Ratelimit-Limit'])
+    except (KeyError, ValueError):
+        return
+    if limit > 0 and limit != limiter.max_rate:
+        if debug:
+            print("[D] Adjusting VirusTotal rate limit to %s requests per %d seconds" % (limit, limiter.time_period))
+        # change the rate of the existing bucket (aiolimiter has no setter), so that its current level and
+        # waiting requests are kept instead of starting over with a full bucket
+        limiter.max_rate = limit
+        limiter._rate_per_sec = limit / limiter.time_period
+
+def getRetryAfter(headers):
+    """
+    Returns the number of seconds in a Retry-After header or None if it's missing or no number
+    :param headers: response headers
+    :return:
+    """
+    try:
+        return max(0.0, float(headers['Retry-After']))
+    except (KeyError, ValueError):
+        return None
+
+def getVTAsyncClient():
+    """
+    Creates the client for the asynchronous API requests
+    All requests are multiplexed as HTTP/2 streams over a single connection
+    :return:
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        timeout=VT_ASYNC_TIMEOUT,
+        headers={'x-apikey': VT_PUBLIC_API_KEY},
+        proxy=PROXY.get('https'),
+    )
+
+async def getVTAsync(client, url, debug=False, limiter=None, semaphore=None):
+    """
+    Rate limited GET request against the VirusTotal API, retries on quota, server and network errors
+    :param client: shared httpx client
+    :param url: requested URL
+    :param limiter: rate limiter of the current run (optional)
+    :param semaphore: semaphore bounding the concurrent requests of the current run (optional)
+    :return: response or None if the request failed on all attempts due to network errors
+    """
+    response = None
+    for attempt in range(VT_MAX_RETRIES):
+        wait_time = 2 ** attempt
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            if semaphore is not None:
+                async with semaphore:
+                    response = await client.get(url)
+            else:
+                response = await client.get(url)
+        except httpx.TransportError as e:
+            response = None
+            if debug:
+                print("[D] Request to VirusTotal failed: %s" % e)
+        else:
+            tuneRateLimit(limiter, response.headers, debug)
+            if response.status_code not in VT_RETRY_STATUS:
+                break
+            if debug:
+                print("[D] Received status code %d from VirusTotal" % response.status_code)
+            # honor the wait time requested by VT
+            retry_after = getRetryAfter(response.headers)
+            if retry_after is not None:
+                if retry_after > VT_MAX_RETRY_AFTER:
+                    print("[W] VirusTotal asked to wait %d seconds, giving up on %s" % (retry_after, url))
+                    break
+                wait_time = max(wait_time, retry_after)
+        if attempt == VT_MAX_RETRIES - 1:
+            break
+        if debug:
+            print("[D] Retrying in %d seconds" % wait_time)
+        await asyncio.sleep(wait_time)
+    return response
+
+def getVTInfo(hash, debug=False, vtallvendors=['ALL'], QUOTA_EXCEEDED_WAIT_TIME=600, vtwaitquota=False):
     """
     Retrieves many different attributes of a sample from Virustotal via its hash
     :param hash:
@@ -22,30 +167,43 @@ def getVTInfo(hash, debug=False, vtallvendors=False, QUOTA_EXCEEDED_WAIT_TIME=60
     """
     # Prepare VT API request
     headers = {"x-apikey": VT_PUBLIC_API_KEY}
-    success = False
-    while not success:
+    attempt = 0
+    while True:
         try:
-            response_dict_code = requests.get(VT_REPORT_URL % hash, headers=headers, proxies=PROXY)
-            response_dict = json.loads(response_dict_code.content.decode("utf-8"))
-            success = True
-            if response_dict_code.status_code == 429:
-                print("VirusTotal Quota exceeded.")
-
-                # only wait if --vtwaitquota to avoid breaking change, and users might be interessested in the results of the other services
-                if vtwaitquota:
-                    print("Waiting for %d seconds before next try." % QUOTA_EXCEEDED_WAIT_TIME)
-                    time.sleep(QUOTA_EXCEEDED_WAIT_TIME)
-
-                    # to stay in while loop
-                    success = False
-        except Exception as e:
+            response_dict_code = VT_SESSION.get(VT_REPORT_URL % hash, headers=headers, proxies=PROXY)
+            response_dict = orjson.loads(response_dict_code.content)
+        except (requests.RequestException, ValueError):
             if debug:
                 traceback.print_exc()
+            # back off exponentially (with jitter) on network errors and give up after VT_MAX_RETRIES attempts
+            attempt += 1
+            if attempt >= VT_MAX_RETRIES:
+                print("[E] Could not query VirusTotal for %s (%d failed attempts)" % (hash, attempt))
+                info = getEmptyInfo()
+                info['hash'] = hash
+                # flag the result so that it doesn't get cached
+                info['vt_failed'] = True
+                return info
+            time.sleep(min(60, 2 ** attempt) + random.random())
+            continue
+
+        if response_dict_code.status_code == 429:
+            print("VirusTotal Quota exceeded.")
+
+            # only wait if --vtwaitquota to avoid breaking change, and users might be interessested in the results of the other services
+            if vtwaitquota:
+                print("Waiting for %d seconds before next try." % QUOTA_EXCEEDED_WAIT_TIME)
+                time.sleep(QUOTA_EXCEEDED_WAIT_TIME)
+                continue
+        break
     if not response_dict_code.ok:
         if debug or not ("error" in response_dict and "code" in response_dict["error"] and "NotFoundError" in response_dict["error"]["code"]):
             print("[D] Received error message from VirusTotal: Status code %d, message %s" % (response_dict_code.status_code,  response_dict_code.content))
         info = getEmptyInfo()
         info['hash'] = hash
+        # quota and server errors say nothing about the sample - flag the result so that it doesn't get cached
+        if response_dict_code.status_code == 429 or response_dict_code.status_code >= 500:
+            info['vt_failed'] = True
         return info
 
     info = processVirustotalSampleInfo(response_dict["data"], debug, vtallvendors)
@@ -54,246 +212,125 @@ def getVTInfo(hash, debug=False, vtallvendors=False, QUOTA_EXCEEDED_WAIT_TIME=60
 
     info['hash'] = hash
     info['tags'] = uniqList(info['tags'])
-
-    # Harmless - TODO: Legacy features
-    if "Probably harmless!" in response_dict_code:
-        info['harmless'] = True
-    # Microsoft Software
-    if "This file belongs to the Microsoft Corporation software catalogue." in response_dict_code:
-        info['mssoft'] = True
     return info
 
-def uniqList(listx):
-    # returns the unique elements of a list
-    return list(set(listx))
+def getRetrohuntResults(retrohunt_id, no_comments=False, debug=False, vtallvendors=['ALL']):
+    """
+    Retrieves all files matched by a retrohunt job
+    (synchronous wrapper around getRetrohuntResultsAsync)
+    """
+    return asyncio.run(getRetrohuntResultsAsync(retrohunt_id, no_comments, debug, vtallvendors))
 
-def getRetrohuntResults(retrohunt_id, no_comments=False, debug=False, vtallvendors=False):
-    headers = { 'x-apikey': VT_PUBLIC_API_KEY}
+async def getRetrohuntResultsAsync(retrohunt_id, no_comments=False, debug=False, vtallvendors=['ALL']):
+    """
+    Walks the pages of a retrohunt job and fetches the comments of all files in a page concurrently
+    """
     url = "%s/%s/matching_files?limit=300" % (RETROHUNT_URL, retrohunt_id)
     files = []
-    while True:
-        response = requests.get(url, headers=headers, proxies=PROXY)
-
-        if not response.ok:
-            print("[E] Error response from VT: Status code %d, message %s" % (response.status_code, response.content))
-            break
-
-        try:
-            response_json = json.loads(response.content)
-        except ValueError:
-            print("[E] Non-JSON response from VT: Message %s" % response.content)
-            break
-
-        for file in response_json["data"]:
-            if "error" in file:
-                print("[W] Skipping file {} due to error: {}".format(file["id"], file["error"]["message"]))
-                continue
-            file_info = processVirustotalSampleInfo(file, debug, vtallvendors)
-            file_info['hash'] = file["id"]  # Add hash info manually, since no original hash exists
-            file_info['matching_rule'] = file["context_attributes"]["rule_name"]
+    printed_dots = 0
+    # limiter and semaphore are created per run since they are bound to the event loop of asyncio.run
+    limiter = getVTAsyncLimiter()
+    semaphore = asyncio.Semaphore(VT_MAX_CONCURRENCY)
+    async with getVTAsyncClient() as client:
+        while True:
+            response = await getVTAsync(client, url, debug, limiter)
+
+            if response is None:
+                print("[E] Could not reach VT after %d attempts, stopping with the results retrieved so far" % VT_MAX_RETRIES)
+                break
+
+            if not response.is_success:
+                print("[E] Error response from VT: Status code %d, message %s" % (response.status_code, response.content))
+                break
+
+            try:
+                response_json = orjson.loads(response.content)
+            except ValueError:
+                print("[E] Non-JSON response from VT: Message %s" % response.content)
+                break
+
+            page_files = []
+            for file in response_json["data"]:
+                if "error" in file:
+                    print("[W] Skipping file {} due to error: {}".format(file["id"], file["error"]["message"]))
+                    continue
+                file_info = processVirustotalSampleInfo(file, debug, vtallvendors)
+                file_info['hash'] = file["id"]  # Add hash info manually, since no original hash exists
+                file_info['matching_rule'] = file["context_attributes"]["rule_name"]
+                page_files.append(file_info)
+
+            # Query the comments of all files of this page concurrently (at most VT_MAX_CONCURRENCY at a time)
             if not no_comments:
-                file_info.update(searchVirustotalComments(file["id"]))
+                comments = await asyncio.gather(
+                    *[searchVirustotalCommentsAsync(client, file_info['hash'], debug, limiter, semaphore)
+                      for file_info in page_files]
+                )
             else:
-                file_info.update({
-                    "comments": 0,
-                    "commenter": []
-                })
+                comments = [{"comments": 0, "commenter": []} for _ in page_files]
 
-            file_info['tags'] = uniqList(file_info['tags'])
+            for file_info, comment_info in zip(page_files, comments):
+                file_info.update(comment_info)
+                file_info['tags'] = uniqList(file_info['tags'])
 
-            files.append(file_info)
+            files.extend(page_files)
 
-        # Print dot to indicate progress
-        print(".", end="")
+            # Print a dot per PROGRESS_STEP files, but at least one per page, to indicate progress (single write per page)
+            dots = max(1, len(files) // PROGRESS_STEP - printed_dots)
+            sys.stdout.write("." * dots)
+            sys.stdout.flush()
+            printed_dots += dots
 
-        if "next" in response_json["links"]:
-            url = response_json["links"]["next"]
-        else:
-            break
+            if "next" in response_json["links"]:
+                url = response_json["links"]["next"]
+            else:
+                break
     return sorted(files, key = lambda i: i['matching_rule'])
 
 
-def convertSize(size_bytes):
-    """
-    Converts number of bytes to a readable form
-    Source: https://stackoverflow.com/questions/5194057/better-way-to-convert-file-sizes-in-python
-    :param size_bytes:
-    :return:
-    """
-    if size_bytes == 0:
-       return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return "%s %s" % (s, size_name[i])
-
-def getEmptyInfo():
-    return {
-        'hash': '-',
-        "result": "- / -",
-        "virus": "-",
-        "last_submitted": "-",
-        "first_submitted": "-",
-        "filenames": "-",
-        "filetype": "-",
-        "rating": "unknown",
-        "positives": 0,
-        "imphash": "-",
-        "harmless": False,
-        "revoked": False,
-        "signed": False,
-        "expired": False,
-        "mssoft": False,
-        "vendor_results": {},
-        "signer": "-",
-        "vt_queried": True,
-        "tags": [],
-        "copyright": "-", 
-        "description": "-",
-        "times_submitted": 0, 
-        "reputation": 0, 
-        "filesize": 0}
-
-def get_crossplatfrom_basename(path):
-    return os.path.basename(path.replace("\\", "/"))
-
-def processVirustotalSampleInfo(sample_info, debug=False, VENDORS=['ALL']):
-    """
-    Processes a v3 API information dictionary of a sample and extracts useful data
-    """
-    info = getEmptyInfo()
+def searchVirustotalComments(sha256, debug=False):
+    info = getEmptyCommentInfo()
 
     try:
-        if 'attributes' not in sample_info:
+        headers = { 'x-apikey': VT_PUBLIC_API_KEY}
+        # Comments
+        r_code_comments = VT_SESSION.get(VT_COMMENT_API % sha256, headers=headers, proxies=PROXY)
+        if not r_code_comments.ok:
+            if debug:
+                print("[D] Could not query comments for sample %s" % sha256)
             return info
-        # Get file names
-        info['filenames'] = list(set(map(get_crossplatfrom_basename, sample_info['attributes']['names'])))
-        if 'meaningful_name' in sample_info['attributes']:
-            meaningful_name = get_crossplatfrom_basename(sample_info['attributes']['meaningful_name'])
-            if meaningful_name in info['filenames']:
-                info['filenames'].remove(meaningful_name) # Prevent duplicate name by removing the other occurrence
-            info['filenames'].insert(0, meaningful_name) # Insert meaningful name to be first, if available
-
-        info["filenames"] = ", ".join(info['filenames']).replace(';', '_')
-        # Get file type
-        info['filetype'] = sample_info['attributes']['type_description']
-        # Get file size
-        info['filesize'] = convertSize(sample_info['attributes']['size'])
-        # Get tags
-        info['tags'] = sample_info['attributes']['tags']
-        # First submission
-        info['first_submitted'] = datetime.utcfromtimestamp(
-            sample_info['attributes']['first_submission_date']
-        ).strftime('%Y-%m-%d %H:%M:%S')
-        # Times submitted
-        info['times_submitted'] = sample_info['attributes']['times_submitted']
-        # Reputation
-        info['reputation'] = sample_info['attributes']['reputation']
-
-        # Exiftool
-        if 'exiftool' in sample_info['attributes']:
-            if 'LegalCopyright' in sample_info['attributes']['exiftool']:
-                # Get copyright
-                if 'LegalCopyright' in sample_info['attributes']['exiftool']:
-                    info['copyright'] = sample_info['attributes']['exiftool']['LegalCopyright']
-                # Get description
-                if 'FileDescription' in sample_info['attributes']['exiftool']:
-                    info['description'] = sample_info['attributes']['exiftool']['FileDescription']
-        # PE Info
-        if 'pe_info' in sample_info['attributes']:
-            if 'imphash' in sample_info['attributes']['pe_info']:
-                # Get additional information
-                info['imphash'] = sample_info['attributes']['pe_info']['imphash']
-        # PE Signature
-        if 'signature_info' in sample_info['attributes']:
-            # Signer
-            if 'signers' in sample_info['attributes']['signature_info']:
-                info['signer'] = sample_info['attributes']['signature_info']['signers']
-            # Valid
-            if 'verified' in sample_info['attributes']['signature_info']:
-                if sample_info['attributes']['signature_info']['verified'] == "Signed":
-                    info['signed'] = True
-                if "Revoked" in sample_info['attributes']['signature_info']['verified']:
-                    info['revoked'] = True
-                if "Expired" in sample_info['attributes']['signature_info']['verified']:
-                    info['expired'] = True
-
-        # Hashes
-        info["md5"] = sample_info['attributes']['md5']
-        info["sha1"] = sample_info['attributes']['sha1']
-        info["sha256"] = sample_info['attributes']['sha256']
-        # AV matches
-        info["positives"] = sample_info["attributes"]["last_analysis_stats"]["malicious"] + sample_info["attributes"]["last_analysis_stats"]["suspicious"]
-        info["total"] = sample_info["attributes"]["last_analysis_stats"]["undetected"] + sample_info["attributes"]["last_analysis_stats"]["malicious"] + sample_info["attributes"]["last_analysis_stats"]["suspicious"] + sample_info["attributes"]["last_analysis_stats"]["harmless"]
-        if info["positives"] == 0:
-            info["rating"] = "clean"
-        elif info["positives"] <= 10:
-            info["rating"] = "suspicious"
-        else:
-            info["rating"] = "malicious"
-
-        info["last_submitted"] = datetime.utcfromtimestamp(
-            sample_info['attributes']['last_submission_date']
-        ).strftime('%Y-%m-%d %H:%M:%S')
-        # Virus Name
-        scans = sample_info['attributes']['last_analysis_results']
-        virus_names = []
-        info["vendor_results"] = {}
-
-        # limit output of VT vendor scan results to those named in VENDORS, unless it's 'ALL'
-        if VENDORS[0] == 'ALL':
-            loop_vendors = scans
-        else:
-            loop_vendors = VENDORS
-
-        for vendor in loop_vendors:
-            if vendor in scans:
-                if scans[vendor]["result"]:
-                    virus_names.append("{0}: {1}".format(vendor, scans[vendor]["result"]))
-                    info["vendor_results"][vendor] = scans[vendor]["result"]
-                else:
-                    info["vendor_results"][vendor] = "-"
-            else:
-                info["vendor_results"][vendor] = "-"
 
-        if len(virus_names) > 0:
-            info["virus"] = " / ".join(virus_names)
+        r_comments = orjson.loads(r_code_comments.content)
+        #print(json.dumps(r_comments, indent=4, sort_keys=True))
+        info = processVirustotalComments(r_comments)
 
     except Exception:
         if debug:
             traceback.print_exc()
-    finally:
-        # Return the info dictionary
-        return info
+    return info
 
-def searchVirustotalComments(sha256, debug=False):
-    info = {
-        "comments": 0,
-        "commenter": ['-'],
-        "tags": []
-    }
+async def searchVirustotalCommentsAsync(client, sha256, debug=False, limiter=None, semaphore=None):
+    """
+    Same as searchVirustotalComments but uses a shared httpx client
+    """
+    info = getEmptyCommentInfo()
 
     try:
-        headers = { 'x-apikey': VT_PUBLIC_API_KEY}
         # Comments
-        r_code_comments = requests.get(VT_COMMENT_API % sha256, headers=headers, proxies=PROXY)
-        if not r_code_comments.ok:
-            if debug:
-                print("[D] Could not query comments for sample %s" % sha256)
+        r_code_comments = await getVTAsync(client, VT_COMMENT_API % sha256, debug, limiter, semaphore)
+        if r_code_comments is None or not r_code_comments.is_success:
+            status = r_code_comments.status_code if r_code_comments is not None else "network error"
+            print("[W] Could not query comments for sample %s (%s)" % (sha256, status))
+            # unknown instead of reporting no comments
+            info['comments'] = '-'
             return info
 
-        r_comments = json.loads(r_code_comments.content.decode("utf-8"))
-        #print(json.dumps(r_comments, indent=4, sort_keys=True))
-        info['comments'] = len(r_comments['data'])
-        if len(r_comments['data']) > 0:
-            info['commenter'] = []
-            for com in r_comments['data']:
-                info['commenter'].append(com['relationships']['author']['data']['id'])
-                info['tags'].extend(com['attributes']['tags'])
-
+        r_comments = orjson.loads(r_code_comments.content)
+        info = processVirustotalComments(r_comments)
 
     except Exception:
+        print("[W] Could not process comments for sample %s" % sha256)
+        info = getEmptyCommentInfo()
+        info['comments'] = '-'
         if debug:
             traceback.print_exc()
     return info
@@ -303,12 +340,12 @@ def checkVirustotalQuota(VT_USERID):
     try:
         headers = { 'x-apikey': VT_PUBLIC_API_KEY}
         # User info
-        r_user = requests.get(VT_USER_API % VT_USERID, headers=headers, proxies=PROXY)
+        r_user = VT_SESSION.get(VT_USER_API % VT_USERID, headers=headers, proxies=PROXY)
         if not r_user.ok:
             print("[D] Could not query quota for user %s" % VT_USERID)
             return 
 
-        r_user_json = json.loads(r_user.content.decode("utf-8"))
+        r_user_json = orjson.loads(r_user.content)
         #print(json.dumps(r_user_json, indent=4, sort_keys=True))
 
         quota_used_day = r_user_json['data']['attributes']['quotas']['api_requests_daily']['used']
@@ -331,7 +368,7 @@ def commentVTSample(resource, comment):
         'resource': resource,
         'comment': comment
     }
-    response = requests.post('https://www.virustotal.com/vtapi/v2/comments/put', params=params, proxies=PROXY)
+    response = VT_SESSION.post('https://www.virustotal.com/vtapi/v2/comments/put', params=params, proxies=PROXY)
     response_json = response.json()
     if response_json['response_code'] != 1:
         print("[E] Error posting comment: %s" % response_json['verbose_msg'])
@@ -1,25 +1,34 @@
 #!/usr/bin/python
 
-import json
+import ijson
 import sys
-import colorama
-from colorama import Fore,Style
 
-with open(sys.argv[1], "r") as f:
-	data = json.load(f)
-print ("----------------------------------------------------")
+SKIP_RATINGS = frozenset({'unknown', 'clean'})
+RED, RESET = "\x1b[31m", "\x1b[0m"
+WRITE_BATCH_SIZE = 1024
 
-print ( "Total Hash Count : %s" % len(data))
+print ("----------------------------------------------------")
 print ( "Showing Suspicious and Malicious Entries Only")
 print ("----------------------------------------------------")
 
-for x in data:
-	if not any(s in x['rating'] for s in ('unknown', 'clean')):
-		if 'malicious' in x['rating']:	
-			print (Fore.RED + "%s has been detected by %s AVs and rated as %s, Possible Filenames include %s." % (x['hash'], x['result'], x['rating'], x['filenames']))
-			print(Style.RESET_ALL, end='')
+count = 0
+# Collect the output lines and write them in batches
+out = []
+with open(sys.argv[1], "rb") as f:
+	# Stream the entries instead of loading the whole result file into memory
+	for x in ijson.items(f, 'item'):
+		count += 1
+		rating = x['rating']
+		if rating in SKIP_RATINGS:
+			continue
+		if rating == 'malicious':
+			out.append(f"{RED}{x['hash']} has been detected by {x['result']} AVs and rated as {rating}, Possible Filenames include {x['filenames']}.{RESET}\n")
 		else:
-			print ("%s has been detected by %s AVs and rated as %s." % (x['hash'], x['result'], x['rating']))
-
-
+			out.append(f"{x['hash']} has been detected by {x['result']} AVs and rated as {rating}.\n")
+		if len(out) >= WRITE_BATCH_SIZE:
+			sys.stdout.write("".join(out))
+			out.clear()
+sys.stdout.write("".join(out))
 
+print ("----------------------------------------------------")
+print ( "Total Hash Count : %s" % count)
@@ -248,8 +248,11 @@ def processLine(line, debug):
                 info.update(vb_info)
 
     # Add to hash cache and current batch info list
+    # (results of failed VT queries are not cached, so they get queried again on the next run)
     if not cache_result:
-        cache.append(info)
+        if not info.get('vt_failed'):
+            info['cache_time'] = int(time.time())
+            cache.append(info)
     # else set vt_queried to False to avoid sleep time
     else:
         info['vt_queried'] = False
@@ -705,7 +708,7 @@ def downloadHybridAnalysisSample(hash):
 
         # If the response is a json file
         if response.headers["Content-Type"] == "application/json":
-            responsejson = json.loads(response.text)
+            responsejson = json.loads(response.content)
             if args.debug:
                 print("[D] Something went wrong: " +responsejson["message"])
             return False
@@ -1087,8 +1090,10 @@ def saveCache(cache, fileName):
     except Exception as e:
         print("[E] Error creating backup file: ", e)
 
+    # drop entries that have expired (they get queried again on the next run)
+    cache_dump = json.dumps([c for c in cache if not isCacheExpired(c)])
     with open(fileName, 'w') as fh:
-        fh.write(json.dumps(cache))
+        fh.write(cache_dump)
 
 
 def loadCache(fileName):
@@ -1123,9 +1128,24 @@ def inCache(hashVal):
         return None
     for c in cache:
         if c['hash'] == hashVal or c['md5'] == hashVal or c['sha1'] == hashVal or c['sha256'] == hashVal:
+            # skip expired entries, a refreshed entry may follow
+            if isCacheExpired(c):
+                continue
             return c
     return None
 
+def isCacheExpired(c):
+    """
+    Check if a cache element is older than the configured time to live (--cachettl / --cachettlclean)
+    :param c: cache element
+    :return: True if the element has to be queried again
+    """
+    ttl = args.cachettl if c.get('positives', 0) else args.cachettlclean
+    if not ttl:
+        return False
+    # entries of older cache databases have no timestamp
+    return time.time() - c.get('cache_time', 0) > ttl * 3600
+
 def getFileData(filePath):
     """
     Get the content of a given file
@@ -1237,6 +1257,8 @@ if __name__ == '__main__':
     parser.add_argument('-d', help='Output Path for Sample Download from Hybrid Analysis. Folder must exist', metavar='download_path',default='./')
 
     parser.add_argument('--nocache', action='store_true', help='Do not use cache database file', default=False)
+    parser.add_argument('--cachettl', help='Query cached hashes with AV matches again after this many hours (default: never)', metavar='hours', type=float, default=0)
+    parser.add_argument('--cachettlclean', help='Query cached hashes without AV matches again after this many hours (default: never)', metavar='hours', type=float, default=0)
     parser.add_argument('--nocsv', action='store_true', help='Do not write a CSV with the results', default=False)
     parser.add_argument('--verifycert', action='store_true', help='Verify SSL/TLS certificates', default=False)
     parser.add_argument('--sort', action='store_true', help='Sort the input lines', default=False)